@@ -1,16 +1,49 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import io
-from openpyxl.utils import get_column_letter
+import xlsxwriter
 import json
 import os
+import hashlib
 from datetime import datetime
 from typing import List
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 def hash_dataframe(df):
-    """Хэширует DataFrame для поддержки @st.cache_data"""
+    """
+    Хэширует DataFrame для поддержки @st.cache_data.
+
+    Если DataFrame получен из загруженных файлов, ключом служит их
+    идентификатор (имя и хэш содержимого) из df.attrs['source_key'] — это избавляет
+    от полного прохода hash_pandas_object по всем строкам на каждом rerun.
+
+    pandas копирует attrs во все производные DataFrame (срезы, take, выбор колонок),
+    поэтому ключ принимается, только если размер и колонки совпадают с теми,
+    что были при его установке (см. set_source_key). Иначе DataFrame хэшируется целиком.
+    """
+    source_key = df.attrs.get('source_key')
+    if source_key is not None and df.attrs.get('source_shape') == (len(df), tuple(df.columns)):
+        return source_key
     return pd.util.hash_pandas_object(df).sum()
 
+def set_source_key(df, source_key):
+    """
+    Задаёт ключ кэширования DataFrame для hash_dataframe.
+
+    Вместе с ключом запоминаются число строк и колонки, чтобы производный
+    DataFrame, унаследовавший attrs, не получил чужой ключ.
+
+    Args:
+        df (pd.DataFrame): DataFrame, для которого задаётся ключ
+        source_key (tuple): Идентификатор источника данных и применённых фильтров
+    """
+    df.attrs['source_key'] = source_key
+    df.attrs['source_shape'] = (len(df), tuple(df.columns))
+
 # предполагаем, что mapping.json лежит рядом с этим файлом
 here = os.path.dirname(__file__)
 with open(os.path.join(here, "mapping.json"), "r", encoding="utf-8") as f:
@@ -26,15 +59,27 @@ CHANNEL_MAPPING = {
     "Больничный" : ["Больничный"]
 }
 
-def inject_custom_css():
-    """
-    Внедряет пользовательские стили в приложение Streamlit.
-    Улучшает внешний вид интерфейса с помощью CSS.
-    Использует цвета из текущей темы Streamlit (light/dark).
+# Обратное отображение: активность → канал коммуникации
+ACT_TO_CHANNEL = {act: channel for channel, acts in CHANNEL_MAPPING.items() for act in acts}
+
+# Максимальное число потоков для параллельной загрузки файлов (не больше числа ядер)
+LOAD_MAX_WORKERS = min(8, os.cpu_count() or 1)
+
+# Сколько слотов обрабатывается за один проход при расчёте пересечений
+SLOT_BLOCK_SIZE = 512
+
+@st.cache_data(show_spinner=False)
+def build_custom_css(theme_type):
     """
-    # Получаем тип темы: 'light' или 'dark'
-    theme_type = st.context.theme.type
+    Собирает блок <style> с пользовательскими стилями для заданной темы.
+    Результат кэшируется, поэтому строка CSS собирается один раз на тему.
 
+    Args:
+        theme_type (str): Тип темы Streamlit — 'light' или 'dark'
+
+    Returns:
+        str: HTML-блок <style> для st.markdown
+    """
     # Определяем цвета в зависимости от темы
     if theme_type == "light":
         background = "#FFFFFF"     # белый фон
@@ -45,8 +90,7 @@ def inject_custom_css():
 
     primary_color = "#3498db"      # основной цвет (можно оставить фиксированным)
 
-    # Внедряем CSS
-    st.markdown(f"""
+    return f"""
         <style>
             :root {{
                 --bg-color: {background};
@@ -100,29 +144,71 @@ def inject_custom_css():
                 margin-right: 5px;
             }}
         </style>
-    """, unsafe_allow_html=True)
+    """
+
+def inject_custom_css():
+    """
+    Внедряет пользовательские стили в приложение Streamlit.
+    Улучшает внешний вид интерфейса с помощью CSS.
+    Использует цвета из текущей темы Streamlit (light/dark).
+    """
+    # Получаем тип темы: 'light' или 'dark'
+    theme_type = st.context.theme.type
+    st.markdown(build_custom_css(theme_type), unsafe_allow_html=True)
+
+def isin_mask(series, values):
+    """
+    Возвращает булеву маску принадлежности значений series списку values.
+
+    Для колонок category сравнение идёт по целочисленным кодам категорий
+    через np.isin, без поэлементного сравнения строк.
+
+    Args:
+        series (pd.Series): Проверяемая колонка
+        values (list): Допустимые значения
+
+    Returns:
+        np.ndarray: Булева маска длины len(series)
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes = series.cat.categories.get_indexer(values)
+        return np.isin(series.cat.codes.values, codes[codes >= 0])
+    return series.isin(values).values
 
-def filter_data(df_act, selected_variants, selected_main_acts):
+@st.cache_data(show_spinner=False, max_entries=16, hash_funcs={pd.DataFrame: hash_dataframe})
+def filter_data(df_act, selected_variants, selected_channels):
     """
-    Фильтрует DataFrame активности по выбранным группам навыков и типам активности.
+    Фильтрует DataFrame активности по выбранным группам навыков и каналам коммуникации.
+
+    Результат кэшируется по идентификатору исходных файлов и набору фильтров,
+    поэтому смена даты или режима не запускает фильтрацию заново.
 
     Args:
         df_act (pd.DataFrame): Исходный DataFrame активности
         selected_variants (list[str]): Список выбранных групп навыков
-        selected_main_acts (list[str]): Список типов активности для фильтрации
+        selected_channels (list[str]): Список каналов коммуникации для фильтрации
 
     Returns:
         pd.DataFrame: Отфильтрованный DataFrame
     """
-    return df_act[
-        df_act['skill_variant'].isin(selected_variants) &
-        df_act['main_act'].isin(selected_main_acts)
-    ]
+    mask = (
+        isin_mask(df_act['skill_variant'], selected_variants) &
+        isin_mask(df_act['channel'], selected_channels)
+    )
+    df_filtered = df_act.take(np.flatnonzero(mask))
+    set_source_key(
+        df_filtered, (df_act.attrs.get('source_key'), tuple(selected_variants), tuple(selected_channels))
+    )
+    return df_filtered
 
 def process_forecast(forecast_file, selected_system_groups, selected_channels, selected_forecast_col):
     """
        Обрабатывает данные прогноза: загружает, проверяет, фильтрует и возвращает df_forecast
 
+    Колонки 'system_group' и 'Канал коммуникации' приходят из load_forecast
+    категориями, поэтому выбранные значения переводятся в коды категорий
+    и фильтрация выполняется по целым числам, без сравнения строк.
+
     Args:
         forecast_file (io.BytesIO): Загруженный файл прогноза
         selected_system_groups (list[str]): Системные группы, по которым фильтруется прогноз
@@ -130,9 +216,10 @@ def process_forecast(forecast_file, selected_system_groups, selected_channels, s
         selected_forecast_col (str): Название колонки прогноза (например, 'Прогноз Raw')
 
     Returns:
-        pd.DataFrame: Обработанный DataFrame прогноза
+        tuple[pd.DataFrame, list[str]]: Обработанный DataFrame прогноза и тексты
+            ошибок загрузки файлов прогноза
     """
-    df_forecast = load_forecast(forecast_file)
+    df_forecast, load_errors = load_forecast(forecast_file)
 
     # --- Проверка: файл прогноза загружен, но пустой ---
     if forecast_file is not None and df_forecast.empty:
@@ -145,17 +232,23 @@ def process_forecast(forecast_file, selected_system_groups, selected_channels, s
         st.markdown("Загрузите файл прогноза в боковой панели, чтобы использовать прогнозные значения.")
 
     if not df_forecast.empty:
-        df_forecast = df_forecast[
-            df_forecast['system_group'].isin(selected_system_groups) &
-            df_forecast['Канал коммуникации'].isin(selected_channels)
-        ]
+        # Колонки-категории: сравнение идёт по целочисленным кодам (isin_mask)
+        mask = (
+            isin_mask(df_forecast['system_group'], selected_system_groups) &
+            isin_mask(df_forecast['Канал коммуникации'], selected_channels)
+        )
+        df_forecast = df_forecast.take(np.flatnonzero(mask))
 
         # Выбираем только нужную колонку прогноза
         df_forecast = df_forecast[[
-            'Дата', 'Время', 'system_group', 'Канал коммуникации', selected_forecast_col
+            'Дата', 'Время', 'ts', 'system_group', 'Канал коммуникации', selected_forecast_col
         ]].rename(columns={selected_forecast_col: 'Прогноз'})
+        set_source_key(df_forecast, (
+            df_forecast.attrs.get('source_key'),
+            tuple(selected_system_groups), tuple(selected_channels), selected_forecast_col
+        ))
 
-    return df_forecast
+    return df_forecast, load_errors
 
 def render_filters(df_act):
     """
@@ -174,72 +267,71 @@ def render_filters(df_act):
             - selected_forecast_col (str): Выбранная колонка прогноза
             - selected_variants (list[str]): Выбранные группы навыков
             - selected_channels (list[str]): Выбранные каналы коммуникации
-            - selected_main_acts (list[str]): Активности, соответствующие каналам
     """
     with st.sidebar.expander("🔮 **Параметры фильтрации**", expanded=True):
-        # Фильтр версии прогноза
-        forecast_columns = ['Прогноз Raw', 'Прогноз Abs_new', 'Прогноз Full']
-        selected_forecast_col = st.selectbox(
-            "Выберите колонку прогноза",
-            options=forecast_columns,
-            index=0,
-            key="forecast_col_filter"
-        )
-
-        # Фильтр скилл-групп
-        variants = sorted(df_act['skill_variant'].dropna().astype(str).unique())
-        selected_variants = st.multiselect(
-            "**Группы навыков**",
-            options=variants,
-            default=variants,
-            help="Выберите одну или несколько групп",
-            placeholder="Поиск...",
-            key="skill_filter",
-            format_func=lambda x: f"🎯 {x}"
-        )
-
-        # Индикатор выбора
-        st.write(
-            f"<span style='font-size:0.9em; color:#7f8c8d;'>Выбрано: {len(selected_variants)} групп</span>",
-            unsafe_allow_html=True
-        )
-
-        # Разделитель
-        st.markdown("<hr style='margin:1.5rem 0; border-color:#eee;'>", unsafe_allow_html=True)
-
-        # Фильтр каналов
-        selected_channels = st.multiselect(
-            "**Каналы коммуникации**",
-            options=list(CHANNEL_MAPPING.keys()),
-            default=["Входящие звонки", "Чаты"],
-            format_func=lambda x: {
-                "Входящие звонки": "📞 Входящие звонки",
-                "Оффлайн функционал": "💻 Оффлайн",
-                "Чаты": "💬 Чаты",
-                "Перерывы": "☕ Перерывы",
-                "Отработки-Доп рабочие интервалы": "👨‍💻 Отработка-Допка",
-                "Отпуск": "🏖️ Отпуск",
-                "Больничный": "🏥 Больничный"
-            }[x],
-            key="channel_filter"
-        )
-
-        selected_main_acts = [act for channel in selected_channels for act in CHANNEL_MAPPING[channel]]
-
-        # Кнопка применения
-        if st.button(
+        # Форма: изменения фильтров применяются одним перезапуском по кнопке
+        with st.form("filters_form", border=False):
+            # Фильтр версии прогноза
+            forecast_columns = ['Прогноз Raw', 'Прогноз Abs_new', 'Прогноз Full']
+            selected_forecast_col = st.selectbox(
+                "Выберите колонку прогноза",
+                options=forecast_columns,
+                index=0,
+                key="forecast_col_filter"
+            )
+
+            # Фильтр скилл-групп
+            variants = df_act.attrs.get('variants')
+            if variants is None:
+                variants = sorted(df_act['skill_variant'].dropna().astype(str).unique())
+            selected_variants = st.multiselect(
+                "**Группы навыков**",
+                options=variants,
+                default=variants,
+                help="Выберите одну или несколько групп",
+                placeholder="Поиск...",
+                key="skill_filter",
+                format_func=lambda x: f"🎯 {x}"
+            )
+
+            # Индикатор выбора
+            st.write(
+                f"<span style='font-size:0.9em; color:#7f8c8d;'>Выбрано: {len(selected_variants)} групп</span>",
+                unsafe_allow_html=True
+            )
+
+            # Разделитель
+            st.markdown("<hr style='margin:1.5rem 0; border-color:#eee;'>", unsafe_allow_html=True)
+
+            # Фильтр каналов
+            selected_channels = st.multiselect(
+                "**Каналы коммуникации**",
+                options=list(CHANNEL_MAPPING.keys()),
+                default=["Входящие звонки", "Чаты"],
+                format_func=lambda x: {
+                    "Входящие звонки": "📞 Входящие звонки",
+                    "Оффлайн функционал": "💻 Оффлайн",
+                    "Чаты": "💬 Чаты",
+                    "Перерывы": "☕ Перерывы",
+                    "Отработки-Доп рабочие интервалы": "👨‍💻 Отработка-Допка",
+                    "Отпуск": "🏖️ Отпуск",
+                    "Больничный": "🏥 Больничный"
+                }[x],
+                key="channel_filter"
+            )
+
+            # Кнопка применения
+            st.form_submit_button(
                 "🔄 Обновить данные",
                 type="primary",
                 use_container_width=True,
                 help="Применить выбранные фильтры"
-        ):
-            st.rerun()
+            )
 
     return {
         'selected_forecast_col': selected_forecast_col,
         'selected_variants': selected_variants,
-        'selected_channels': selected_channels,
-        'selected_main_acts': selected_main_acts
+        'selected_channels': selected_channels
     }
 
 
@@ -247,6 +339,12 @@ def filter_by_period(df_filtered, start_dt, end_dt):
     """
     Фильтрует DataFrame активности по временному диапазону.
 
+    Если DataFrame помечен как отсортированный по 'start'
+    (attrs['sorted_by_start'], см. combine_activity), окно строк находится
+    через searchsorted: активность длится не дольше attrs['max_duration'],
+    поэтому начавшаяся раньше start_dt - max_duration уже закончилась.
+    Маска по 'end' проверяется только внутри этого окна.
+
     Args:
         df_filtered (pd.DataFrame): Отфильтрованный DataFrame активности
         start_dt (datetime): Начало временного диапазона
@@ -257,9 +355,19 @@ def filter_by_period(df_filtered, start_dt, end_dt):
     """
     if start_dt is None or end_dt is None:
         return df_filtered
-    return df_filtered[
-        (df_filtered['start'] < end_dt) & (df_filtered['end'] > start_dt)
-        ]
+
+    max_duration = df_filtered.attrs.get('max_duration')
+    if not df_filtered.attrs.get('sorted_by_start') or max_duration is None:
+        return df_filtered[
+            (df_filtered['start'] < end_dt) & (df_filtered['end'] > start_dt)
+            ]
+
+    start_dt, end_dt = pd.Timestamp(start_dt), pd.Timestamp(end_dt)
+    starts = df_filtered['start'].values
+    lo = np.searchsorted(starts, (start_dt - max_duration).to_datetime64(), side='right')
+    hi = np.searchsorted(starts, end_dt.to_datetime64(), side='left')
+    df_window = df_filtered.iloc[lo:hi]
+    return df_window[df_window['end'].values > start_dt.to_datetime64()]
 
 def calculate_plan(df_period, times: List[datetime], is_hourly=True):
     """
@@ -273,17 +381,9 @@ def calculate_plan(df_period, times: List[datetime], is_hourly=True):
     Returns:
         pd.DataFrame: DataFrame с колонкой 'План' (в часах)
     """
-    plan_list = []
-    for t in times:
-        if is_hourly:
-            start = t
-            end = t + pd.Timedelta(minutes=30)
-        else:
-            start = t
-            end = t + pd.Timedelta(days=1)
-        plan = calculate_overlap(df_period, start, end)
-        plan_list.append({'slot_start': t, 'План': plan})
-    return pd.DataFrame(plan_list).set_index('slot_start')
+    slot_len = pd.Timedelta(minutes=30) if is_hourly else pd.Timedelta(days=1)
+    plan = calculate_slot_overlaps(df_period, times, slot_len)
+    return pd.DataFrame({'План': plan}, index=pd.DatetimeIndex(times, name='slot_start'))
 
 def calculate_forecast(df_forecast, times, start_dt=None, end_dt=None, is_hourly=True):
     """
@@ -302,20 +402,14 @@ def calculate_forecast(df_forecast, times, start_dt=None, end_dt=None, is_hourly
     if df_forecast.empty:
         return pd.DataFrame({'slot_start': times, 'Прогноз': [0.0] * len(times)}).set_index('slot_start')
 
-    df_fc = df_forecast.copy()
-    df_fc['ts'] = pd.to_datetime(df_fc['Дата'] + ' ' + df_fc['Время'])
-    if not is_hourly:
-        df_fc = df_fc[(df_fc['ts'] >= start_dt) & (df_fc['ts'] < end_dt)]
-
-    forecast_list = []
-    for t in times:
-        if is_hourly:
-            mask = df_fc['ts'] == t
-        else:
-            mask = (df_fc['ts'] >= t) & (df_fc['ts'] < t + pd.Timedelta(days=1))
-        forecast_list.append({'slot_start': t, 'Прогноз': df_fc.loc[mask, 'Прогноз'].sum()})
+    if is_hourly:
+        agg = df_forecast.groupby('ts', sort=False)['Прогноз'].sum()
+    else:
+        df_period = df_forecast[(df_forecast['ts'] >= start_dt) & (df_forecast['ts'] < end_dt)]
+        agg = df_period.groupby(df_period['ts'].dt.floor('D'), sort=False)['Прогноз'].sum()
 
-    return pd.DataFrame(forecast_list).set_index('slot_start')
+    forecast = agg.reindex(pd.DatetimeIndex(times, name='slot_start'), fill_value=0.0)
+    return forecast.to_frame('Прогноз')
 
 def finalize_slot_df(plan_df, forecast_df, year=None, month=None):
     """
@@ -333,32 +427,33 @@ def finalize_slot_df(plan_df, forecast_df, year=None, month=None):
             - 'Равномерность' (float)
     """
     # Объединяем по слотам
-    slot_df = pd.concat([plan_df, forecast_df], axis=1).fillna(0)
-    slot_df = slot_df.reset_index()
-    slot_df['slot_start'] = pd.to_datetime(slot_df['slot_start'])
+    idx = plan_df.index.union(forecast_df.index)
+    plan = plan_df['План'].reindex(idx, fill_value=0.0).values
+    forecast = forecast_df['Прогноз'].reindex(idx, fill_value=0.0).values
 
     # 🔥 Фильтрация по году и месяцу, если переданы
     if year is not None and month is not None:
-        slot_df = slot_df[
-            (slot_df['slot_start'].dt.year == year) &
-            (slot_df['slot_start'].dt.month == month)
-        ]
+        mask = (idx.year == year) & (idx.month == month)
+        idx, plan, forecast = idx[mask], plan[mask], forecast[mask]
 
     # Проверка на пустоту
-    if slot_df.empty:
+    if len(idx) == 0:
         st.warning("⚠️ Нет данных для расчёта равномерности.")
         return pd.DataFrame()
 
     # Рассчитываем только по данным выбранного периода
-    total_plan = slot_df['План'].sum()
-    total_forecast = slot_df['Прогноз'].sum()
+    total_plan = plan.sum()
+    total_forecast = forecast.sum()
 
     # Защита от деления на 0
     k = total_plan / total_forecast if total_forecast > 0 else 0.0
 
-    slot_df['Равномерность'] = slot_df['Прогноз'] * k
-
-    return slot_df
+    return pd.DataFrame({
+        'slot_start': idx,
+        'План': plan,
+        'Прогноз': forecast,
+        'Равномерность': forecast * k
+    })
 
 
 def prepare_slot_data(mode, df_filtered, df_forecast, min_date, max_date):
@@ -388,37 +483,30 @@ def prepare_slot_data(mode, df_filtered, df_forecast, min_date, max_date):
         selected_date = st.session_state.selected_date
         start_dt = pd.to_datetime(selected_date)
         end_dt = start_dt + pd.Timedelta(days=1)
-    else:
-        # Для режима "По дням" start_dt и end_dt остаются None
-        start_dt = pd.to_datetime(min_date)
-        end_dt = pd.to_datetime(max_date) + pd.Timedelta(days=1)
 
-    # --- 🔥 ФИЛЬТРАЦИЯ ПО ПЕРИОДУ ---
-    if start_dt is not None and end_dt is not None:
+        # --- 🔥 ФИЛЬТРАЦИЯ ПО ПЕРИОДУ ---
         df_period = filter_by_period(df_filtered, start_dt, end_dt)
-    else:
-        df_period = df_filtered.copy()
 
-    # 3. Создание слотов и расчёт
-    if mode == "По часам":
+        # 3. Создание слотов и расчёт
         times = pd.date_range(start=start_dt, end=end_dt, freq='30min', inclusive='left').tolist()
         plan_df = calculate_plan(df_period, times, is_hourly=True)
         forecast_df = calculate_forecast(df_forecast, times, is_hourly=True)
     else:
+        start_dt = pd.to_datetime(min_date)
+        end_dt = pd.to_datetime(max_date) + pd.Timedelta(days=1)
+
         # Для режима "По дням" используем диапазон от min_date до max_date
         times = pd.date_range(start=min_date, end=max_date, freq='D', inclusive='left').tolist()
-        df_period = df_filtered.copy()  # Полный период
+        df_period = df_filtered  # Полный период
 
         # --- 🔥 ДОПОЛНИТЕЛЬНАЯ ФИЛЬТРАЦИЯ ПО МЕСЯЦУ ---
         if 'year' in st.session_state and 'month' in st.session_state:
-            selected_year = st.session_state.selected_year
-            selected_month = st.session_state.selected_month
-            df_period = df_period[
-                df_period['start'].dt.year == selected_year
-                ]
-            df_period = df_period[
-                df_period['start'].dt.month == selected_month
-                ]
+            starts = df_filtered['start'].dt
+            mask = (
+                (starts.year.values == st.session_state.selected_year) &
+                (starts.month.values == st.session_state.selected_month)
+            )
+            df_period = df_filtered[mask]
 
         plan_df = calculate_plan(df_period, times, is_hourly=False)
         forecast_df = calculate_forecast(df_forecast, times, start_dt=start_dt, end_dt=end_dt, is_hourly=False)
@@ -435,6 +523,43 @@ def prepare_slot_data(mode, df_filtered, df_forecast, min_date, max_date):
         'end_dt': end_dt
     }
 
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_chart(slot_df, mode, title):
+    """
+    Строит линейный график плана, прогноза и равномерности.
+
+    Результат кэшируется по содержимому slot_df, режиму и заголовку, поэтому
+    при rerun с теми же данными фигура Plotly не собирается заново.
+
+    Args:
+        slot_df (pd.DataFrame): Данные по слотам
+        mode (str): Режим отображения ('По часам' или 'По дням')
+        title (str): Заголовок графика
+
+    Returns:
+        dict: Описание фигуры Plotly для st.plotly_chart
+    """
+    fig = px.line(
+        slot_df,
+        x='slot_start',
+        y=['План', 'Прогноз', 'Равномерность'],
+        labels={'slot_start': 'Время/Дата', 'value': 'Человеко-часы'},
+        title=title,
+        color_discrete_map={'План': 'green', 'Прогноз': 'red', 'Равномерность': 'orange'},
+    )
+    fig.update_traces(visible='legendonly', selector=dict(name='Равномерность'))
+
+    if mode == "По часам":
+        fig.update_xaxes(tickformat='%H:%M', dtick=30 * 60 * 1000)
+    else:
+        fig.update_xaxes(tickformat='%Y-%m-%d', dtick="D1")
+
+    # Установка нижней границы Y-оси в 0
+    max_value = slot_df[['План', 'Прогноз', 'Равномерность']].max().max()
+    fig.update_layout(yaxis=dict(range=[0, max_value + 1 if max_value > 0 else 1]))
+
+    return fig.to_dict()
+
 def render_chart_and_table(slot_df, mode, selected_date=None, year=None, month=None):
     """
     Строит график и отображает таблицу на основе slot_df
@@ -461,31 +586,11 @@ def render_chart_and_table(slot_df, mode, selected_date=None, year=None, month=N
         if mode == "По часам"
         else f"Дневной обзор — {year}-{month:02d}"
     )
-    fig = px.line(
-        slot_df,
-        x='slot_start',
-        y=['План', 'Прогноз', 'Равномерность'],
-        labels={'slot_start': 'Время/Дата', 'value': 'Человеко-часы'},
-        title=title,
-        color_discrete_map={'План': 'green', 'Прогноз': 'red', 'Равномерность': 'orange'},
-    )
-    fig.update_traces(visible='legendonly', selector=dict(name='Равномерность'))
-
-    if mode == "По часам":
-        fig.update_xaxes(tickformat='%H:%M', dtick=30 * 60 * 1000)
-    else:
-        fig.update_xaxes(tickformat='%Y-%m-%d', dtick="D1")
-
-    # Установка нижней границы Y-оси в 0
-    max_value = slot_df[['План', 'Прогноз', 'Равномерность']].max().max()
-    fig.update_layout(yaxis=dict(range=[0, max_value + 1 if max_value > 0 else 1]))
-
     if slot_df['План'].sum() + slot_df['Прогноз'].sum() == 0:
         st.warning("Нет данных для построения графика. Проверьте:")
-        st.markdown("- Корректность временных интервалов")
-        st.markdown("- Наличие активностей в выбранный период")
+        st.markdown("- Корректность временных интервалов\n- Наличие активностей в выбранный период")
     else:
-        st.plotly_chart(fig, use_container_width=True)
+        st.plotly_chart(build_chart(slot_df, mode, title), use_container_width=True)
 
     # --- Таблица данных ---
     st.subheader("📊 Таблица данных: План и Прогноз")
@@ -520,6 +625,60 @@ def render_chart_and_table(slot_df, mode, selected_date=None, year=None, month=N
         hide_index=True
     )
 
+def excel_column_width(values, col):
+    """
+    Рассчитывает ширину колонки Excel по самому длинному значению или заголовку.
+
+    Длины строк считаются векторно через .str.len(), без вызова len на каждую ячейку.
+
+    Args:
+        values (pd.Series): Значения колонки
+        col (str): Заголовок колонки
+
+    Returns:
+        int: Ширина колонки в символах
+    """
+    lengths = values.astype('string').str.len()
+    max_length = int(lengths.max()) if lengths.notna().any() else 0
+    return max(max_length, len(str(col))) + 2
+
+def write_excel_streaming(df, sheet_name):
+    """
+    Записывает DataFrame в XLSX через xlsxwriter в режиме constant_memory.
+
+    Строки пишутся по одной сверху вниз, поэтому в памяти держится только
+    текущая строка, а не вся книга. DataFrame.to_excel для этого не подходит:
+    он пишет ячейки по столбцам, и в режиме constant_memory данные теряются.
+    Даты пишутся с форматом 'YYYY-MM-DD', время — строкой, как в pandas.
+
+    Args:
+        df (pd.DataFrame): Данные для выгрузки
+        sheet_name (str): Название листа
+
+    Returns:
+        io.BytesIO: Готовый XLSX-файл
+    """
+    buf = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buf, {'constant_memory': True, 'default_date_format': 'YYYY-MM-DD'})
+    ws = workbook.add_worksheet(sheet_name)
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+
+    columns = []
+    for i, col in enumerate(df.columns):
+        values = df[col]
+        if pd.api.types.infer_dtype(values, skipna=True) == 'time':
+            values = values.astype(str)
+        ws.set_column(i, i, excel_column_width(values, col))
+        columns.append(values.astype(object).where(values.notna(), None))
+
+    ws.write_row(0, 0, [str(col) for col in df.columns], header_format)
+    for row, record in enumerate(zip(*columns), start=1):
+        ws.write_row(row, 0, record)
+
+    workbook.close()
+    buf.seek(0)
+    return buf
+
 def render_export_buttons(slot_df, mode, df_filtered, df_forecast, selected_channels, selected_variants, selected_date=None, year=None, month=None):
     """
     Отображает кнопки экспорта данных в Excel.
@@ -528,7 +687,7 @@ def render_export_buttons(slot_df, mode, df_filtered, df_forecast, selected_chan
     - 'По дням'  → использует year и month
     """
     # Подготовка данных для "По интервалам"
-    output_df = slot_df.copy()
+    output_df = slot_df[['slot_start', 'План', 'Прогноз']].copy()
     output_df['Дельта'] = output_df['План'] - output_df['Прогноз']
     output_df['Дата'] = output_df['slot_start'].dt.date
 
@@ -539,14 +698,7 @@ def render_export_buttons(slot_df, mode, df_filtered, df_forecast, selected_chan
         cols_sel = ['Дата', 'План', 'Прогноз', 'Дельта']
 
     # Формирование Excel-файла "По интервалам"
-    buf_sel = io.BytesIO()
-    with pd.ExcelWriter(buf_sel, engine='openpyxl') as writer:
-        output_df[cols_sel].to_excel(writer, sheet_name='Интервалы', index=False)
-        ws = writer.sheets['Интервалы']
-        for i, col in enumerate(cols_sel, start=1):
-            w = max(output_df[col].astype(str).map(len).max(), len(col)) + 2
-            ws.column_dimensions[get_column_letter(i)].width = w
-    buf_sel.seek(0)
+    buf_sel = write_excel_streaming(output_df[cols_sel], sheet_name='Интервалы')
 
     # Формирование имени файла
     timestamp = pd.Timestamp.now().strftime('%Y%m%d_%H%M')
@@ -570,14 +722,7 @@ def render_export_buttons(slot_df, mode, df_filtered, df_forecast, selected_chan
         with c2:
             with st.spinner("⏳ Формируем KPI за месяц..."):
                 kpi_df = calculate_monthly_kpi(df_filtered, df_forecast, selected_channels, selected_variants, year, month)
-                buf_kpi = io.BytesIO()
-                with pd.ExcelWriter(buf_kpi, engine='openpyxl') as writer:
-                    kpi_df.to_excel(writer, sheet_name='KPI_30м', index=False)
-                    ws_kpi = writer.sheets['KPI_30м']
-                    for i, col in enumerate(kpi_df.columns, start=1):
-                        w = max(kpi_df[col].astype(str).map(len).max(), len(col)) + 2
-                        ws_kpi.column_dimensions[get_column_letter(i)].width = w
-                buf_kpi.seek(0)
+                buf_kpi = write_excel_streaming(kpi_df, sheet_name='KPI_30м')
 
                 st.download_button(
                     label="⬇️ По выбранным интервалам за месяц (30-минутные слоты)",
@@ -586,71 +731,173 @@ def render_export_buttons(slot_df, mode, df_filtered, df_forecast, selected_chan
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                 )
 
+def month_bounds(year, month):
+    """
+    Возвращает границы месяца: начало месяца и начало следующего.
+
+    Считается арифметикой numpy datetime64 с точностью до месяца,
+    без объектов pd.offsets.
+
+    Args:
+        year (int): Год
+        month (int): Месяц (1-12)
+
+    Returns:
+        tuple[pd.Timestamp, pd.Timestamp]: Начало месяца (включительно) и конец (исключительно)
+    """
+    start = np.datetime64(f"{int(year):04d}-{int(month):02d}", 'M')
+    end = start + np.timedelta64(1, 'M')
+    return pd.Timestamp(start.astype('datetime64[ns]')), pd.Timestamp(end.astype('datetime64[ns]'))
+
 @st.cache_data(hash_funcs={pd.DataFrame: hash_dataframe})
 def calculate_monthly_kpi(df_filtered, df_forecast, selected_channels, selected_variants, year, month):
-    start_month = pd.Timestamp(year=year, month=month, day=1)
-    end_month = start_month + pd.offsets.MonthEnd(1) + pd.Timedelta(days=1)
+    start_month, end_month = month_bounds(year, month)
     slots_month = pd.date_range(start=start_month, end=end_month, freq='30min', inclusive='left')
 
     df_act_m = df_filtered[(df_filtered['start'] < end_month) & (df_filtered['end'] > start_month)]
 
+    # Каркас результата: канал × скилл-группа × слот
+    n_channels, n_variants, n_slots = len(selected_channels), len(selected_variants), len(slots_month)
+    channel_pos = {channel: i for i, channel in enumerate(selected_channels)}
+    variant_pos = {variant: j for j, variant in enumerate(selected_variants)}
+
+    # План: пересечение активностей каждой пары (канал, скилл-группа) со всеми слотами месяца
+    plan = np.zeros((n_channels, n_variants, n_slots))
+    for (channel, skill_variant), df_group in df_act_m.groupby(
+            ['channel', 'skill_variant'], sort=False, observed=True
+    ):
+        if channel in channel_pos and skill_variant in variant_pos:
+            plan[channel_pos[channel], variant_pos[skill_variant]] = calculate_slot_overlaps(
+                df_group, slots_month, pd.Timedelta(minutes=30)
+            )
+
+    kpi_channels = np.repeat(np.asarray(selected_channels, dtype=object), n_variants * n_slots)
+    kpi_variants = np.tile(np.repeat(np.asarray(selected_variants, dtype=object), n_slots), n_channels)
+    kpi_slots = np.tile(slots_month.values, n_channels * n_variants)
+
+    # 🔁 Прогноз агрегируется по системной группе из VARIANT_TO_SYSTEM
     if not df_forecast.empty:
-        df_fc_m = df_forecast.copy()
-        df_fc_m['ts'] = pd.to_datetime(df_fc_m['Дата'] + ' ' + df_fc_m['Время'])
-        df_fc_m = df_fc_m[(df_fc_m['ts'] >= start_month) & (df_fc_m['ts'] < end_month)]
+        df_fc_m = df_forecast[(df_forecast['ts'] >= start_month) & (df_forecast['ts'] < end_month)]
 
-        if 'skill_variant' not in df_fc_m.columns:
-            df_fc_m['skill_variant'] = 'Не задано'
+        fc_agg = df_fc_m.groupby(
+            ['Канал коммуникации', 'system_group', 'ts'], sort=False, observed=True
+        )['Прогноз'].sum()
+        variant_system_groups = np.asarray(
+            [VARIANT_TO_SYSTEM.get(v, v) for v in selected_variants], dtype=object
+        )
+        kpi_system_groups = np.tile(np.repeat(variant_system_groups, n_slots), n_channels)
+        forecast = fc_agg.reindex(
+            pd.MultiIndex.from_arrays([kpi_channels, kpi_system_groups, kpi_slots]),
+            fill_value=0.0
+        ).values
     else:
-        df_fc_m = pd.DataFrame(columns=['ts', 'Прогноз', 'Канал коммуникации', 'skill_variant'])
+        forecast = np.zeros(len(kpi_slots))
+
+    kpi_index = pd.DatetimeIndex(kpi_slots)
+    kpi_df = pd.DataFrame({
+        'Дата': kpi_index.date,
+        'Время': kpi_index.time,
+        'Канал коммуникации': kpi_channels,
+        'Скилл группа': kpi_variants,
+        'План': plan.ravel(),
+        'Прогноз': forecast
+    })
+    kpi_df['Дельта'] = kpi_df['План'] - kpi_df['Прогноз']
+    return kpi_df
 
-    kpi_data = []
+def combine_date_time(dates, times):
+    """
+    Собирает временные метки из колонки даты и колонки времени.
 
-    for channel in selected_channels:
-        df_act_channel = df_act_m[df_act_m['main_act'].isin(CHANNEL_MAPPING[channel])]
+    Дата и время разбираются отдельно и складываются как datetime + timedelta,
+    без промежуточной склейки строк. Повторяющиеся даты разбираются один раз
+    (cache=True). Время допускается в форматах 'ЧЧ:ММ:СС' и 'ЧЧ:ММ'.
 
-        for skill_variant in selected_variants:
-            # 🔁 Получаем системную группу из VARIANT_TO_SYSTEM
-            system_group = VARIANT_TO_SYSTEM.get(skill_variant, skill_variant)
+    Args:
+        dates (pd.Series): Даты (строки или datetime)
+        times (pd.Series): Время в виде строк
 
-            # Фильтруем активность по оригинальной skill_variant
-            df_act_skill = df_act_channel[df_act_channel['skill_variant'] == skill_variant]
+    Returns:
+        pd.Series: Временные метки; NaT для некорректных значений
+    """
+    dates = pd.to_datetime(dates, errors='coerce', cache=True).dt.normalize()
+    offsets = pd.to_timedelta(times, errors='coerce')
 
-            # 🔁 Фильтруем прогноз по системной группе
-            df_fc_channel = df_fc_m[
-                (df_fc_m['Канал коммуникации'] == channel) &
-                (df_fc_m['system_group'] == system_group)
-            ]
+    # Время без секунд ('ЧЧ:ММ') to_timedelta не разбирает — дописываем секунды
+    short = offsets.isna() & times.notna()
+    if short.any():
+        offsets[short] = pd.to_timedelta(times[short] + ':00', errors='coerce')
 
-            for ts in slots_month:
-                plan = calculate_overlap(df_act_skill, ts, ts + pd.Timedelta(minutes=30))
-                forecast = df_fc_channel[df_fc_channel['ts'] == ts]['Прогноз'].sum()
-                kpi_data.append({
-                    'Дата': ts.date(),
-                    'Время': ts.time(),
-                    'Канал коммуникации': channel,
-                    'Скилл группа': skill_variant,
-                    'План': plan,
-                    'Прогноз': forecast
-                })
-
-    kpi_df = pd.DataFrame(kpi_data)
-    kpi_df['Дельта'] = kpi_df['План'] - kpi_df['Прогноз']
-    return kpi_df
+    return dates + offsets
 
-@st.cache_data
-def load_activity(file) -> pd.DataFrame:
+def read_xlsx(file, dtype):
     """
-    Загружает и валидирует файл активности.
+    Читает XLSX-файл в DataFrame.
+
+    Используется движок calamine (пакет python-calamine, парсер на Rust), который
+    заметно быстрее и экономнее openpyxl. Если пакет не установлен, чтение
+    выполняется через openpyxl.
 
     Args:
         file (io.BytesIO): Загруженный XLSX-файл
+        dtype (dict): Типы колонок для pd.read_excel
+
+    Returns:
+        pd.DataFrame: Содержимое первого листа
+    """
+    try:
+        return pd.read_excel(file, engine='calamine', dtype=dtype)
+    except ImportError:
+        file.seek(0)
+        return pd.read_excel(file, engine='openpyxl', dtype=dtype)
+
+def map_in_threads(func, items):
+    """
+    Применяет func к каждому элементу items в пуле потоков, сохраняя порядок.
+
+    Разбор XLSX-файлов идёт параллельно. Потокам передаётся контекст текущего
+    запуска Streamlit, чтобы внутри func работал st.cache_data. Выводить
+    сообщения (st.error/st.warning) из func нельзя: при повторе закэшированного
+    результата из потока пула они отображаются ненадёжно. func должна
+    возвращать текст ошибки, а выводит его основной поток.
+
+    Args:
+        func (callable): Функция загрузки одного файла
+        items (list): Загруженные файлы
+
+    Returns:
+        list: Результаты func в порядке items
+    """
+    if len(items) <= 1:
+        return [func(item) for item in items]
+
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(
+            max_workers=min(len(items), LOAD_MAX_WORKERS),
+            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+    ) as executor:
+        return list(executor.map(func, items))
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def load_activity(file_bytes, name):
+    """
+    Загружает и валидирует файл активности.
+
+    Принимает содержимое файла в виде bytes, поэтому кэш st.cache_data
+    ключуется по самим данным, а не по объекту UploadedFile. Функция
+    выполняется в потоках пула, поэтому сама ничего не выводит на страницу,
+    а возвращает текст ошибки.
+
+    Args:
+        file_bytes (bytes): Содержимое XLSX-файла
+        name (str): Имя файла
 
     Returns:
-        pd.DataFrame: Обработанный DataFrame активности
+        tuple[pd.DataFrame, str | None]: Обработанный DataFrame активности (пустой при ошибке)
+            и текст ошибки (None, если файл загружен)
     """
     try:
-        df = pd.read_excel(file, dtype={
+        df = read_xlsx(io.BytesIO(file_bytes), dtype={
             'activity_date': str,
             'start_time': str,
             'end_time': str,
@@ -661,8 +908,7 @@ def load_activity(file) -> pd.DataFrame:
         # Проверка обязательных колонок
         required_columns = ['activity_date', 'start_time', 'end_time', 'Скилл-группа', 'main_act']
         if not all(col in df.columns for col in required_columns):
-            st.error(f"Отсутствуют колонки: {set(required_columns) - set(df.columns)}")
-            return pd.DataFrame()
+            return pd.DataFrame(), f"Отсутствуют колонки: {set(required_columns) - set(df.columns)}"
 
         # Сохраняем оригинал в skill_variant и мапим в system_group
         df['skill_variant'] = df['Скилл-группа']
@@ -670,32 +916,108 @@ def load_activity(file) -> pd.DataFrame:
             .map(VARIANT_TO_SYSTEM) \
             .fillna(df['skill_variant'])
             # Создание временных меток
-        df['start'] = pd.to_datetime(
-            df['activity_date'] + ' ' + df['start_time'],
-            errors='coerce'
-        )
-        df['end'] = pd.to_datetime(
-            df['activity_date'] + ' ' + df['end_time'],
-            errors='coerce'
-        )
+        activity_date = pd.to_datetime(df['activity_date'], errors='coerce', cache=True)
+        df['start'] = combine_date_time(activity_date, df['start_time'])
+        df['end'] = combine_date_time(activity_date, df['end_time'])
 
         # Проверка ошибок конвертации
         if df[['start', 'end']].isnull().any().any():
-            st.error("Ошибка в формате даты/времени. Проверьте входные данные.")
-            return pd.DataFrame()
+            return pd.DataFrame(), "Ошибка в формате даты/времени. Проверьте входные данные."
+
+        # Корректировка перехода через полночь: +1 день там, где end <= start
+        start_i8 = df['start'].to_numpy(dtype='datetime64[ns]').view('i8')
+        end_i8 = df['end'].to_numpy(dtype='datetime64[ns]').view('i8')
+        end_i8 = end_i8 + (end_i8 <= start_i8) * pd.Timedelta(days=1).value
+        df['end'] = end_i8.view('datetime64[ns]')
 
-        # Корректировка перехода через полночь
-        df.loc[df['end'] <= df['start'], 'end'] += pd.Timedelta(days=1)
+        df = df.dropna(subset=['start', 'end'])
 
-        return df.dropna(subset=['start', 'end'])
+        # Канал коммуникации определяется по типу активности
+        df['channel'] = df['main_act'].map(ACT_TO_CHANNEL)
+
+        # Низкокардинальные текстовые колонки храним как category
+        for col in ('skill_variant', 'system_group', 'main_act', 'Скилл-группа', 'channel'):
+            df[col] = df[col].astype('category')
+
+        # Остальные текстовые колонки храним в Arrow-строках: в разы компактнее object
+        text_columns = df.select_dtypes(include='object').columns
+        df[text_columns] = df[text_columns].astype('string[pyarrow]')
+
+        # Хэш содержимого считается один раз: load_activity кэшируется по bytes
+        set_source_key(df, (name, hashlib.blake2b(file_bytes, digest_size=16).hexdigest()))
+        df.attrs['variants'] = sorted(df['skill_variant'].dropna().astype(str).unique())
+        return df, None
 
     except Exception as e:
-        st.error(f"Ошибка загрузки активности: {str(e)}")
-        return pd.DataFrame()
+        return pd.DataFrame(), f"Ошибка загрузки активности: {str(e)}"
+
+
+def concat_frames(dfs):
+    """
+    Объединяет DataFrame'ы из нескольких файлов, сохраняя колонки category.
+
+    Если категории в файлах различаются, pd.concat превращает такие колонки
+    в object. Поэтому сначала всем частям задаётся общий набор категорий.
+
+    Args:
+        dfs (list[pd.DataFrame]): Непустой список DataFrame'ов с одинаковыми колонками
+
+    Returns:
+        pd.DataFrame: Объединённый DataFrame
+    """
+    if len(dfs) == 1:
+        return dfs[0].reset_index(drop=True)
+
+    category_dtypes = {
+        col: pd.CategoricalDtype(
+            pd.api.types.union_categoricals([df[col] for df in dfs], ignore_order=True).categories
+        )
+        for col in dfs[0].columns
+        if all(col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype) for df in dfs)
+    }
+    return pd.concat([df.astype(category_dtypes) for df in dfs], ignore_index=True, copy=False)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def combine_activity(files):
+    """
+    Загружает все файлы активности и объединяет их в один DataFrame.
+
+    Кэшируется по содержимому файлов, поэтому при rerun с теми же файлами
+    ни разбор, ни pd.concat не выполняются повторно. Ошибки загрузки
+    возвращаются вызывающему коду, который выводит их на каждом rerun.
+
+    Args:
+        files (tuple[tuple[bytes, str], ...]): Пары (содержимое файла, имя файла)
+
+    Returns:
+        tuple[pd.DataFrame, list[tuple[str, str]]]:
+            - Объединённый DataFrame активности; пустой, если ни один файл не загружен
+            - Пары (имя файла, текст ошибки) для файлов, которые не удалось загрузить
+    """
+    dfs_act = []
+    failed = []
+    for (_, name), (df, error) in zip(files, map_in_threads(lambda f: load_activity(*f), files)):
+        if not df.empty:
+            dfs_act.append(df)
+        else:
+            failed.append((name, error))
+
+    if not dfs_act:
+        return pd.DataFrame(), failed
+
+    # Сортируем по началу активности: фильтрация сохраняет порядок строк,
+    # поэтому выборку за период можно брать бинарным поиском (filter_by_period)
+    df_act_combined = concat_frames(dfs_act).sort_values('start', kind='stable', ignore_index=True)
+    # Инвариант для filter_by_period: код, меняющий порядок строк, должен сбросить этот флаг
+    df_act_combined.attrs['sorted_by_start'] = True
+    set_source_key(df_act_combined, tuple(df.attrs['source_key'] for df in dfs_act))
+    df_act_combined.attrs['variants'] = sorted(set().union(*(df.attrs['variants'] for df in dfs_act)))
+    df_act_combined.attrs['max_duration'] = (df_act_combined['end'] - df_act_combined['start']).max()
+    return df_act_combined, failed
 
 
 @st.cache_data
-def load_forecast(file) -> pd.DataFrame:
+def load_forecast(file):
     """
     Загружает и валидирует файл прогноза.
 
@@ -703,31 +1025,46 @@ def load_forecast(file) -> pd.DataFrame:
         file (io.BytesIO | list[io.BytesIO]): Загруженный(е) XLSX-файл(ы)
 
     Returns:
-        pd.DataFrame: Обработанный DataFrame прогноза
+        tuple[pd.DataFrame, list[str]]: Обработанный DataFrame прогноза и тексты
+            ошибок загрузки, которые вызывающий код выводит на страницу
     """
     if file is None:
-        return pd.DataFrame()
+        return pd.DataFrame(), []
 
     if isinstance(file, list):
         if not file:  # Если список пуст — возвращаем пустой DataFrame
-            return pd.DataFrame()
+            return pd.DataFrame(), []
 
-        dfs = []
-        for f in file:
-            df = load_forecast_single(f)
-            if not df.empty:
-                dfs.append(df)
-        return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+        results = map_in_threads(load_forecast_single, file)
+        dfs = [df for df, _ in results if not df.empty]
+        errors = [error for _, error in results if error]
+        if not dfs:
+            return pd.DataFrame(), errors
 
-    return load_forecast_single(file)
+        df_forecast = concat_frames(dfs)
+        set_source_key(df_forecast, tuple(df.attrs['source_key'] for df in dfs))
+        return df_forecast, errors
 
+    df_forecast, error = load_forecast_single(file)
+    return df_forecast, [error] if error else []
 
-def load_forecast_single(file) -> pd.DataFrame:
+
+def load_forecast_single(file):
     """
-    Вспомогательная функция для загрузки одного файла прогноза
+    Загружает и валидирует один файл прогноза.
+
+    Функция выполняется в потоках пула, поэтому сама ничего не выводит
+    на страницу, а возвращает текст ошибки.
+
+    Args:
+        file (io.BytesIO): Загруженный XLSX-файл прогноза
+
+    Returns:
+        tuple[pd.DataFrame, str | None]: Обработанный DataFrame прогноза (пустой при ошибке)
+            и текст ошибки (None, если файл загружен)
     """
     try:
-        df = pd.read_excel(file, dtype={
+        df = read_xlsx(file, dtype={
             'Дата': str,
             'Время': str,
             'Скилл группа': str,
@@ -739,44 +1076,67 @@ def load_forecast_single(file) -> pd.DataFrame:
 
         required = ['skill_variant', 'Канал коммуникации', 'Прогноз Raw', 'Прогноз Abs_new', 'Прогноз Full']
         if not all(col in df.columns for col in required):
-            st.error(f"В прогнозе отсутствуют колонки: {set(required) - set(df.columns)}")
-            return pd.DataFrame()
+            return pd.DataFrame(), f"В прогнозе отсутствуют колонки: {set(required) - set(df.columns)}"
 
         df['system_group'] = df['skill_variant'] \
             .map(VARIANT_TO_SYSTEM) \
             .fillna(df['skill_variant'])
+        df['ts'] = combine_date_time(df['Дата'], df['Время'])
 
-        return df
+        # Низкокардинальные текстовые колонки храним как category
+        for col in ('skill_variant', 'system_group', 'Канал коммуникации'):
+            df[col] = df[col].astype('category')
+
+        set_source_key(df, (file.name, hashlib.blake2b(file.getvalue(), digest_size=16).hexdigest()))
+        return df, None
 
     except Exception as e:
-        st.error(f"Ошибка загрузки прогноза: {str(e)}")
-        return pd.DataFrame()
+        return pd.DataFrame(), f"Ошибка загрузки прогноза: {str(e)}"
 
 
-def calculate_overlap(df_activity, slot_start, slot_end):
+def calculate_slot_overlaps(df_activity, slot_starts, slot_len):
     """
-    Рассчитывает пересечение временных интервалов активности с заданным слотом.
+    Рассчитывает пересечение активности сразу со всеми временными слотами.
+
+    Матрица пересечений (активности × слоты) строится блоками по
+    SLOT_BLOCK_SIZE слотов, чтобы ограничить расход памяти. Активности
+    сортируются по началу, и для каждого блока через searchsorted берётся
+    только окно активностей, которые могут с ним пересекаться.
 
     Args:
         df_activity (pd.DataFrame): DataFrame активности
-        slot_start (datetime): Начало временного слота
-        slot_end (datetime): Конец временного слота
+        slot_starts (list[datetime]): Начала временных слотов
+        slot_len (pd.Timedelta): Длительность слота
 
     Returns:
-        float: Время пересечения в часах
+        np.ndarray: Время пересечения в часах для каждого слота
     """
-    df = df_activity.copy()
-    mask = (df['start'] < slot_end) & (df['end'] > slot_start)
-    filtered = df[mask].copy()
-
-    if filtered.empty:
-        return 0.0
-
-    filtered['overlap_start'] = filtered[['start']].apply(lambda x: max(x['start'], slot_start), axis=1)
-    filtered['overlap_end'] = filtered[['end']].apply(lambda x: min(x['end'], slot_end), axis=1)
+    slots = pd.DatetimeIndex(slot_starts).values.astype('datetime64[ns]').view('i8')
+    starts = df_activity['start'].values.astype('datetime64[ns]').view('i8')
+    ends = df_activity['end'].values.astype('datetime64[ns]').view('i8')
+    slot_len_ns = pd.Timedelta(slot_len).value
+
+    if len(starts) > 1 and (starts[1:] < starts[:-1]).any():
+        order = np.argsort(starts, kind='stable')
+        starts, ends = starts[order], ends[order]
+    max_duration = (ends - starts).max() if len(starts) else 0
+
+    total = np.zeros(len(slots), dtype=np.int64)
+    for i in range(0, len(slots), SLOT_BLOCK_SIZE):
+        block = slots[i:i + SLOT_BLOCK_SIZE]
+
+        # Активность, начавшаяся раньше block.min() - max_duration, закончилась до блока
+        lo = np.searchsorted(starts, block.min() - max_duration, side='right')
+        hi = np.searchsorted(starts, block.max() + slot_len_ns, side='left')
+        block_starts, block_ends = starts[lo:hi], ends[lo:hi]
+
+        overlap = (
+            np.minimum(block_ends[:, None], block[None, :] + slot_len_ns) -
+            np.maximum(block_starts[:, None], block[None, :])
+        )
+        total[i:i + SLOT_BLOCK_SIZE] = np.maximum(overlap, 0).sum(axis=0)
 
-    total_seconds = (filtered['overlap_end'] - filtered['overlap_start']).dt.total_seconds().sum()
-    return total_seconds / 3600
+    return total / 3.6e12
 
 def load_and_validate_files():
     """
@@ -827,24 +1187,46 @@ def load_and_validate_files():
               """)
         return None, None, None
 
+    # Те же загрузки, что и в прошлый rerun, — берём готовый DataFrame из session_state,
+    # не перечитывая и не хэшируя содержимое файлов. Спиннер при этом не показываем
+    act_sig = tuple((f.file_id, f.name, f.size) for f in activity_files)
+    if st.session_state.get('_act_sig') == act_sig:
+        return st.session_state['_act_df'], activity_files, forecast_files
+
     with st.spinner('🌀 **Обработка данных...**'):
         # Загрузка и объединение всех файлов активности
-        dfs_act = []
-        for file in activity_files:
-            df = load_activity(file)
-            if not df.empty:
-                dfs_act.append(df)
-            else:
-                st.warning(f"⚠️ Ошибка загрузки файла активности: {file.name}")
+        df_act_combined, failed = combine_activity(tuple((f.getvalue(), f.name) for f in activity_files))
+
+    # Ошибки загрузки выводим здесь, в основном потоке и вне кэшируемых функций
+    for name, error in failed:
+        st.error(error)
+        st.warning(f"⚠️ Ошибка загрузки файла активности: {name}")
 
-        if not dfs_act:
-            st.error("⚠️ Ни один файл активности не загружен корректно.")
-            return None, None, None
+    if df_act_combined.empty:
+        st.error("⚠️ Ни один файл активности не загружен корректно.")
+        return None, None, None
 
-        df_act_combined = pd.concat(dfs_act, ignore_index=True)
+    # Запоминаем только полностью успешную загрузку, чтобы сообщения
+    # об ошибочных файлах продолжали показываться
+    if not failed:
+        st.session_state['_act_sig'] = act_sig
+        st.session_state['_act_df'] = df_act_combined
 
     return df_act_combined, activity_files, forecast_files
 
+@lru_cache(maxsize=64)
+def system_groups_for(variants):
+    """
+    Возвращает системные группы для набора вариантов скилл-групп.
+
+    Args:
+        variants (tuple[str]): Отсортированный кортеж выбранных вариантов
+
+    Returns:
+        tuple[str]: Системные группы без повторов, в порядке вариантов
+    """
+    return tuple(dict.fromkeys(VARIANT_TO_SYSTEM.get(v, v) for v in variants))
+
 def apply_filters_and_process(df_act, filters, forecast_file):
     """
     Применяет фильтры к данным активности и обрабатывает прогноз.
@@ -866,12 +1248,9 @@ def apply_filters_and_process(df_act, filters, forecast_file):
     """
     selected_variants = filters['selected_variants']
     selected_channels = filters['selected_channels']
-    selected_main_acts = filters['selected_main_acts']
     selected_forecast_col = filters['selected_forecast_col']
 
-    selected_system_groups = list({VARIANT_TO_SYSTEM.get(v, v) for v in selected_variants})
-    df_filtered = filter_data(df_act, selected_variants, selected_main_acts)
-    df_forecast = process_forecast(forecast_file, selected_system_groups, selected_channels, selected_forecast_col)
+    df_filtered = filter_data(df_act, selected_variants, selected_channels)
 
     if df_filtered.empty and selected_channels:
         st.warning("⚠️ Нет активности по выбранным каналам коммуникации.")
@@ -880,13 +1259,59 @@ def apply_filters_and_process(df_act, filters, forecast_file):
     if df_filtered.empty:
         reason = "при выбранных фильтрах" if selected_variants or selected_channels else "в исходных данных"
         st.error(f"Нет данных для отображения {reason}. Проверьте:")
-        st.markdown("- Выбранные скилл-группы")
-        st.markdown("- Выбранные каналы коммуникации")
+        st.markdown("- Выбранные скилл-группы\n- Выбранные каналы коммуникации")
         return None, None
 
+    # Прогноз обрабатываем, только если есть активность для сравнения
+    selected_system_groups = system_groups_for(tuple(sorted(selected_variants)))
+
+    # Прогноз с теми же файлами и фильтрами, что в прошлый rerun, берём из session_state
+    fc_key = (
+        tuple((f.file_id, f.name, f.size) for f in forecast_file or ()),
+        selected_system_groups, tuple(selected_channels), selected_forecast_col
+    )
+    if st.session_state.get('_fc_key') == fc_key:
+        df_forecast = st.session_state['_fc_df']
+        forecast_errors = st.session_state['_fc_errors']
+    else:
+        df_forecast, forecast_errors = process_forecast(
+            forecast_file, selected_system_groups, selected_channels, selected_forecast_col
+        )
+        # Пустой прогноз не запоминаем, чтобы предупреждения о нём показывались при каждом rerun
+        if not df_forecast.empty:
+            st.session_state['_fc_key'] = fc_key
+            st.session_state['_fc_df'] = df_forecast
+            st.session_state['_fc_errors'] = forecast_errors
+
+    # Ошибки загрузки прогноза выводим на каждом rerun, в том числе из session_state
+    for error in forecast_errors:
+        st.error(error)
+
     return df_filtered, df_forecast
 
 
+@st.cache_data(show_spinner=False, max_entries=16, hash_funcs={pd.DataFrame: hash_dataframe})
+def year_month_index(df_filtered):
+    """
+    Строит индекс доступных периодов: год → отсортированный список месяцев.
+
+    Кэшируется по источнику данных и фильтрам (df.attrs['source_key']), поэтому
+    полный проход по колонке 'start' выполняется один раз, а не на каждом rerun.
+
+    Args:
+        df_filtered (pd.DataFrame): Отфильтрованный DataFrame активности
+
+    Returns:
+        dict[int, list[int]]: Годы по возрастанию и месяцы каждого года
+    """
+    # Номера месяцев от эпохи: год и месяц получаются арифметикой за один проход
+    months = np.unique(df_filtered['start'].values.astype('datetime64[M]').view('i8'))
+
+    index = {}
+    for year, month in zip((months // 12 + 1970).tolist(), (months % 12 + 1).tolist()):
+        index.setdefault(year, []).append(month)
+    return index
+
 def get_period_params(df_filtered):
     """
     Возвращает параметры выбранного периода: режим, дату/месяц, временные границы.
@@ -910,9 +1335,10 @@ def get_period_params(df_filtered):
         st.error("⚠️ Нет данных для обработки даты и режима.")
         return {}
 
-        # Определяем общий диапазон дат один раз
-    min_date = df_filtered['start'].min().date()
-    max_date = df_filtered['start'].max().date()
+    # Определяем общий диапазон дат один раз (редукция прямо по массиву numpy)
+    starts = df_filtered['start'].to_numpy()
+    min_date = starts.min().astype('datetime64[D]').item()
+    max_date = starts.max().astype('datetime64[D]').item()
 
     # Инициализируем session_state, если не задано
     if 'selected_date' not in st.session_state:
@@ -951,24 +1377,21 @@ def get_period_params(df_filtered):
             key='period_selection_date_input'
         )
 
-        if selected_date != st.session_state.selected_date:
-            st.session_state.selected_date = selected_date
-            st.rerun()
+        # Виджет с key сам хранит значение — перезапуск скрипта не нужен
+        st.session_state.selected_date = selected_date
 
         start_dt = pd.to_datetime(selected_date)
         end_dt = start_dt + pd.Timedelta(days=1)
 
     else:
-        # Получаем доступные годы
-        available_years = sorted(df_filtered['start'].dt.year.unique())
+        # Доступные годы и месяцы берём из закэшированного индекса
+        year_months = year_month_index(df_filtered)
 
-        # Получаем доступные месяцы для выбранного года
-        selected_year = st.session_state.selected_year
-        available_months = sorted(
-            df_filtered[df_filtered['start'].dt.year == selected_year]['start'].dt.month.unique()
-        )
+        # Получаем доступные годы
+        available_years = list(year_months)
 
         # Выбор года
+        selected_year = st.session_state.selected_year
         year = st.sidebar.selectbox(
             "Год",
             options=available_years,
@@ -976,10 +1399,8 @@ def get_period_params(df_filtered):
             key='period_selection_year'
         )
 
-        # Обновляем доступные месяцы для нового года
-        available_months = sorted(
-            df_filtered[df_filtered['start'].dt.year == year]['start'].dt.month.unique()
-        )
+        # Доступные месяцы для выбранного года
+        available_months = year_months[year]
 
         # Если текущий месяц не в списке — выбираем первый
         selected_month = st.session_state.selected_month
@@ -998,8 +1419,7 @@ def get_period_params(df_filtered):
         st.session_state.selected_year = year
         st.session_state.selected_month = month
 
-        start_dt = pd.Timestamp(year=year, month=month, day=1)
-        end_dt = (start_dt + pd.offsets.MonthEnd(1)) + pd.Timedelta(days=1)
+        start_dt, end_dt = month_bounds(year, month)
 
     return {
         'mode': mode,
@@ -1058,7 +1478,6 @@ def run_streamlit():
     filters = render_filters(df_act_combined)
     selected_channels = filters['selected_channels']
     selected_variants = filters['selected_variants']
-    selected_main_acts = filters['selected_main_acts']
     selected_forecast_col = filters['selected_forecast_col']
 
     df_filtered, df_forecast = apply_filters_and_process(df_act_combined, filters, forecast_file)